@@ -230,60 +230,83 @@ export default function Home() {
     const API_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:5000';
     let cancelled = false;
 
+    const applyProgress = (data: any) => {
+      if (typeof data.progress === 'number') {
+        setProcessingProgress(data.progress);
+      }
+
+      const nextStage = mapServerStageToProcessing(data.stage, data.status);
+      setProcessingStage(prev => (nextStage ? nextStage : prev));
+
+      if (Array.isArray(data.tasks) && data.tasks.length) {
+        const logEntries = data.tasks
+          .filter((task: any) => task.status !== 'pending')
+          .map((task: any) => ({
+            stage: taskStageMap[task.id] || 'detect',
+            label: `${task.label}${task.detail ? ` · ${task.detail}` : ''}`,
+            timestamp: new Date().toLocaleTimeString(),
+          }));
+        if (logEntries.length) {
+          setActivityLog(logEntries.slice(-7));
+        }
+      }
+
+      if (data.tiktokCaption) {
+        setTiktokCaption(data.tiktokCaption);
+      }
+
+      if (data.status === 'analyzed') {
+        // Analysis complete, switch to editor
+        setBestMoments(data.moments || []);
+        if (data.videoDurations) setVideoDurations(data.videoDurations);
+        setProcessingStage('render'); // use 'render' visual stage for 'Ready to Edit'
+        setStep('editor');
+        setIsProcessing(false); // Stop the spinner loop visual? keep polling?
+        // We need to keep polling if we were waiting, but here we pause.
+        // Actually we stop polling when not isProcessing, so setting isProcessing=false stops it.
+      } else if (data.status === 'ready') {
+        setBestMoments(data.moments || []);
+        setProcessingProgress(100);
+        setProcessingStage('completed');
+        setIsProcessing(false);
+        setStep('preview');
+      } else if (data.status === 'error') {
+        setError(data.error || 'Erreur pendant la compilation.');
+        setProcessingStage('error');
+        setIsProcessing(false);
+        setStep('input');
+      }
+    };
+
+    const stopPolling = () => {
+      if (progressPollRef.current) {
+        clearInterval(progressPollRef.current);
+        progressPollRef.current = null;
+      }
+    };
+
+    // The session expired or was deleted: nothing more will come for it
+    const handleSessionGone = () => {
+      stopPolling();
+      setError('Session expirée ou introuvable. Relancez l’analyse.');
+      setProcessingStage('error');
+      setIsProcessing(false);
+      setStep('input');
+    };
+
     const fetchProgress = async () => {
       try {
         const response = await fetch(`${API_URL}/api/progress/${sessionId}`);
+        if (response.status === 404) {
+          if (!cancelled) handleSessionGone();
+          return;
+        }
         if (!response.ok) {
           throw new Error('Failed to fetch progress');
         }
         const data = await response.json();
         if (cancelled) return;
-
-        if (typeof data.progress === 'number') {
-          setProcessingProgress(data.progress);
-        }
-
-        const nextStage = mapServerStageToProcessing(data.stage, data.status);
-        setProcessingStage(prev => (nextStage ? nextStage : prev));
-
-        if (Array.isArray(data.tasks) && data.tasks.length) {
-          const logEntries = data.tasks
-            .filter((task: any) => task.status !== 'pending')
-            .map((task: any) => ({
-              stage: taskStageMap[task.id] || 'detect',
-              label: `${task.label}${task.detail ? ` · ${task.detail}` : ''}`,
-              timestamp: new Date().toLocaleTimeString(),
-            }));
-          if (logEntries.length) {
-            setActivityLog(logEntries.slice(-7));
-          }
-        }
-
-        if (data.tiktokCaption) {
-          setTiktokCaption(data.tiktokCaption);
-        }
-
-        if (data.status === 'analyzed') {
-          // Analysis complete, switch to editor
-          setBestMoments(data.moments || []);
-          if (data.videoDurations) setVideoDurations(data.videoDurations);
-          setProcessingStage('render'); // use 'render' visual stage for 'Ready to Edit'
-          setStep('editor');
-          setIsProcessing(false); // Stop the spinner loop visual? keep polling?
-          // We need to keep polling if we were waiting, but here we pause.
-          // Actually we stop polling when not isProcessing, so setting isProcessing=false stops it.
-        } else if (data.status === 'ready') {
-          setBestMoments(data.moments || []);
-          setProcessingProgress(100);
-          setProcessingStage('completed');
-          setIsProcessing(false);
-          setStep('preview');
-        } else if (data.status === 'error') {
-          setError(data.error || 'Erreur pendant la compilation.');
-          setProcessingStage('error');
-          setIsProcessing(false);
-          setStep('input');
-        }
+        applyProgress(data);
       } catch (err) {
         if (!cancelled) {
           console.error('[v0] Progress polling error:', err);
@@ -291,14 +314,43 @@ export default function Home() {
       }
     };
 
-    fetchProgress();
-    const intervalId = setInterval(fetchProgress, 2000);
-    progressPollRef.current = intervalId;
+    const startPolling = () => {
+      if (cancelled || progressPollRef.current) return;
+      fetchProgress();
+      progressPollRef.current = setInterval(fetchProgress, 2000);
+    };
+
+    // Prefer the server-sent progress stream; fall back to polling if it fails
+    let eventSource: EventSource | null = null;
+    if (typeof EventSource !== 'undefined') {
+      eventSource = new EventSource(`${API_URL}/api/progress/${sessionId}/stream`);
+      eventSource.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        // The server ends the stream after a final status; don't reconnect
+        if (['analyzed', 'ready', 'error'].includes(data.status)) {
+          eventSource?.close();
+        }
+        if (!cancelled) applyProgress(data);
+      };
+      // Sent instead of progress when the session no longer exists; polling would only get 404s
+      eventSource.addEventListener('gone', () => {
+        eventSource?.close();
+        eventSource = null;
+        if (!cancelled) handleSessionGone();
+      });
+      eventSource.onerror = () => {
+        eventSource?.close();
+        eventSource = null;
+        startPolling();
+      };
+    } else {
+      startPolling();
+    }
 
     return () => {
       cancelled = true;
-      clearInterval(intervalId);
-      progressPollRef.current = null;
+      eventSource?.close();
+      stopPolling();
     };
   }, [sessionId, isProcessing]);
 
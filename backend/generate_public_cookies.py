@@ -41,6 +41,68 @@ def to_netscape(cookies: Iterable[dict]) -> str:
     return "\n".join(lines) + "\n"
 
 
+CONSENT_BUTTONS = ", ".join([
+    "button:has-text('Reject all')",
+    "button:has-text('I agree')",
+    "button:has-text('Agree')",
+    "button:has-text('Accept all')",
+])
+
+# Where YouTube stores the consent choice (SOCS, or CONSENT on older setups)
+CONSENT_COOKIES = {"SOCS", "CONSENT"}
+
+
+def generate_cookies(output_path: Path, user_agent: str) -> Path:
+    """Load the YouTube homepage in a headless browser and write its cookies to output_path."""
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        try:
+            return _export_cookies(browser, output_path, user_agent)
+        finally:
+            browser.close()
+
+
+def _export_cookies(browser, output_path: Path, user_agent: str) -> Path:
+    context = browser.new_context(
+        user_agent=user_agent,
+        locale="en-US",
+        geolocation={"latitude": 37.4219999, "longitude": -122.0840575},
+        permissions=["geolocation"],
+    )
+    try:
+        page = context.new_page()
+
+        # YouTube keeps long-poll requests open, so "networkidle" can stall for the full timeout
+        page.goto("https://www.youtube.com", wait_until="domcontentloaded", timeout=15000)
+
+        # Try to close/accept consent if present
+        clicked = False
+        try:
+            button = page.locator(CONSENT_BUTTONS).first
+            if button.count():
+                button.click(timeout=2000)
+                clicked = True
+        except Exception:
+            pass
+
+        # Short wait instead of a fixed sleep: for the consent cookie after a
+        # click (the page-load cookies are there before it), otherwise for any cookie
+        cookies = context.cookies()
+        for _ in range(15):
+            if clicked:
+                if any(c.get("name") in CONSENT_COOKIES for c in cookies):
+                    break
+            elif cookies:
+                break
+            page.wait_for_timeout(200)
+            cookies = context.cookies()
+
+        output_path.write_text(to_netscape(cookies), encoding="utf-8")
+        return output_path
+    finally:
+        context.close()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Generate public YouTube cookies for yt-dlp.")
     parser.add_argument(
@@ -61,40 +123,7 @@ def main():
     output_path = Path(args.output).expanduser()
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(
-            user_agent=args.user_agent,
-            locale="en-US",
-            geolocation={"latitude": 37.4219999, "longitude": -122.0840575},
-            permissions=["geolocation"],
-        )
-        page = context.new_page()
-
-        page.goto("https://www.youtube.com", wait_until="networkidle")
-
-        # Try to close/accept consent if present
-        try:
-            for selector in [
-                "button:has-text('Reject all')",
-                "button:has-text('I agree')",
-                "button:has-text('Agree')",
-                "button:has-text('Accept all')",
-            ]:
-                if page.is_visible(selector):
-                    page.click(selector, timeout=1000)
-                    break
-        except Exception:
-            pass
-
-        # Small wait to ensure cookies are set
-        page.wait_for_timeout(1000)
-
-        cookies = context.cookies()
-        netscape = to_netscape(cookies)
-        output_path.write_text(netscape, encoding="utf-8")
-
-        browser.close()
+    generate_cookies(output_path, args.user_agent)
 
     print(f"[ok] Cookies written to {output_path}")
 
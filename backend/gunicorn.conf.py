@@ -0,0 +1,28 @@
+"""
+Gunicorn configuration for the compiler backend
+Usage: gunicorn -c gunicorn.conf.py server:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Sessions are only shared between processes through Redis or SQLite:
+# without REDIS_URL or SESSION_DB a single worker must serve every request
+# of a session
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY',
+    multiprocessing.cpu_count() if os.environ.get('REDIS_URL') or os.environ.get('SESSION_DB') else 1
+))
+# Each open progress stream holds a thread for the whole analysis, so the
+# default thread count leaves room for them next to regular requests.
+# GUNICORN_WORKER_CLASS=gevent (needs `pip install gevent`) serves them as
+# greenlets instead; ffmpeg and yt-dlp already wait in subprocesses and sockets.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+
+# Downloads stream whole compilations; keep slow clients from being killed
+timeout = 600
+graceful_timeout = 30
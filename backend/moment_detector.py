@@ -4,22 +4,28 @@ Analyzes videos to detect the best moments for compilation
 """
 
 import subprocess
-import json
 import logging
 import numpy as np
 from pathlib import Path
 import random
 import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
 logger = logging.getLogger(__name__)
 
 
 class MomentDetector:
-    def __init__(self):
+    def __init__(self, ffmpeg_slots=None):
         self.scene_threshold = 0.4
         self.min_clip_duration = 6
         self.max_clip_duration = 9
         self.scene_padding = 0.75
+        self.audio_sample_rate = 8000
+        self.ffmpeg_timeout = 300  # 5 minutes max
+        # Semaphore shared by everything that starts ffmpeg in this process
+        self.ffmpeg_slots = ffmpeg_slots or nullcontext()
     
     def get_video_duration(self, video_path):
         """Get video duration using ffprobe"""
@@ -28,7 +34,7 @@ class MomentDetector:
                 'ffprobe',
                 '-v', 'error',
                 '-show_entries', 'format=duration',
-                '-of', 'json',
+                '-of', 'default=noprint_wrappers=1:nokey=1',
                 video_path
             ]
             
@@ -37,51 +43,131 @@ class MomentDetector:
             if result.returncode != 0:
                 raise RuntimeError(f"ffprobe error: {result.stderr}")
             
-            data = json.loads(result.stdout)
-            duration = float(data['format']['duration'])
+            duration = float(result.stdout.strip())
             return duration
         
         except Exception as e:
             logger.error(f"Error getting video duration: {e}")
             raise
     
-    def detect_scene_changes(self, video_path, max_scenes=50):
+    def _parse_scene_times(self, log_lines, max_scenes):
+        """Extract showinfo timestamps from ffmpeg stderr, line by line"""
+        scene_times = []
+        for line in log_lines:
+            if 'pts_time' in line:
+                try:
+                    # Extract timestamp
+                    parts = line.split('pts_time:')
+                    if len(parts) > 1:
+                        time_str = parts[1].split()[0]
+                        timestamp = float(time_str)
+                        scene_times.append(timestamp)
+                except (ValueError, IndexError):
+                    continue
+        
+        # Limit number of scenes
+        if len(scene_times) > max_scenes:
+            # Sample evenly
+            step = len(scene_times) // max_scenes
+            scene_times = scene_times[::step][:max_scenes]
+        
+        return scene_times
+    
+    def _read_energy_levels(self, pcm_stream, duration, num_samples):
+        """
+        Stream raw s16le mono PCM and return one RMS value per window
+        (num_samples windows over the expected duration), or None if the
+        track is too short to fill them.
+        """
+        window = max(1, int(duration * self.audio_sample_rate / num_samples))
+        squares = np.zeros(num_samples)
+        counts = np.zeros(num_samples)
+        position = 0
+        leftover = b''
+        
+        for chunk in iter(lambda: pcm_stream.read(65536), b''):
+            data = leftover + chunk
+            usable = len(data) - (len(data) % 2)
+            leftover = data[usable:]
+            samples = np.frombuffer(data[:usable], dtype=np.int16)
+            if not samples.size:
+                continue
+            # Windows are contiguous: sum each one's slice of the chunk
+            # instead of binning sample by sample
+            bins = np.arange(position // window, (position + samples.size - 1) // window + 1)
+            offsets = np.maximum(bins * window - position, 0)
+            sums = np.add.reduceat(np.square(samples, dtype=np.float64), offsets)
+            lengths = np.diff(offsets, append=samples.size)
+            # Samples past the expected duration land in the last window
+            bins = np.minimum(bins, num_samples - 1)
+            np.add.at(squares, bins, sums)
+            np.add.at(counts, bins, lengths)
+            position += samples.size
+        
+        if position < num_samples:
+            return None
+        return np.sqrt(squares / np.maximum(counts, 1)).astype(np.float32)
+    
+    def _energy_timestamps(self, energy_levels, duration, num_samples):
+        """Turn per-window RMS levels into timestamps of high audio energy"""
+        if energy_levels is None:
+            # Fallback to uniform distribution
+            return [i * (duration / num_samples) for i in range(num_samples)]
+        
+        # Get timestamps of high energy
+        energy_levels = np.asarray(energy_levels, dtype=np.float32)
+        threshold = np.percentile(energy_levels, 70)  # Top 30%
+        high_energy_indices = np.flatnonzero(energy_levels >= threshold)
+        
+        return (high_energy_indices * (duration / energy_levels.size)).tolist()
+    
+    def _pcm_output_args(self):
+        return ['-ac', '1', '-ar', str(self.audio_sample_rate), '-f', 's16le']
+    
+    def _thread_args(self, threads):
+        """ffmpeg thread cap, repeated before the input and each output (None = ffmpeg default)"""
+        return ['-threads', str(threads)] if threads else []
+    
+    @contextmanager
+    def _spawn_ffmpeg(self, cmd, **popen_kwargs):
+        """
+        Run ffmpeg for the duration of the block, once an ffmpeg slot is free,
+        with a watchdog that kills it after ffmpeg_timeout seconds
+        """
+        with self.ffmpeg_slots:
+            process = subprocess.Popen(cmd, **popen_kwargs)
+            watchdog = threading.Timer(self.ffmpeg_timeout, process.kill)
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                with process:
+                    yield process
+            finally:
+                watchdog.cancel()
+    
+    def detect_scene_changes(self, video_path, max_scenes=50, ffmpeg_threads=None):
         """Detect scene changes in the video using FFmpeg"""
         try:
             cmd = [
                 'ffmpeg',
+                '-nostats',
+                *self._thread_args(ffmpeg_threads),
                 '-i', video_path,
+                *self._thread_args(ffmpeg_threads),
                 '-vf', f'select=gt(scene\\,{self.scene_threshold}),showinfo',
                 '-f', 'null',
                 '-'
             ]
             
-            result = subprocess.run(
+            with self._spawn_ffmpeg(
                 cmd,
-                capture_output=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 text=True,
-                timeout=300  # 5 minutes max
-            )
-            
-            # Parse scene changes from ffmpeg output
-            scene_times = []
-            for line in result.stderr.split('\n'):
-                if 'pts_time' in line:
-                    try:
-                        # Extract timestamp
-                        parts = line.split('pts_time:')
-                        if len(parts) > 1:
-                            time_str = parts[1].split()[0]
-                            timestamp = float(time_str)
-                            scene_times.append(timestamp)
-                    except (ValueError, IndexError):
-                        continue
-            
-            # Limit number of scenes
-            if len(scene_times) > max_scenes:
-                # Sample evenly
-                step = len(scene_times) // max_scenes
-                scene_times = scene_times[::step][:max_scenes]
+                errors='ignore'
+            ) as process:
+                # Parse scene changes as ffmpeg emits them
+                scene_times = self._parse_scene_times(process.stderr, max_scenes)
             
             logger.info(f"Detected {len(scene_times)} scene changes")
             return scene_times
@@ -90,62 +176,29 @@ class MomentDetector:
             logger.error(f"Error detecting scenes: {e}")
             return []
     
-    def analyze_audio_energy(self, video_path, num_samples=100):
+    def analyze_audio_energy(self, video_path, duration, num_samples=100, ffmpeg_threads=None):
         """Analyze audio energy levels to find engaging moments"""
         try:
-            duration = self.get_video_duration(video_path)
-            
-            # Extract audio stats using ffmpeg
+            # Decode a mono low-rate PCM stream and compute RMS in NumPy
             cmd = [
                 'ffmpeg',
+                '-v', 'error',
+                *self._thread_args(ffmpeg_threads),
                 '-i', video_path,
-                '-af', 'astats=metadata=1:reset=1',
-                '-f', 'null',
+                *self._thread_args(ffmpeg_threads),
+                '-vn',
+                *self._pcm_output_args(),
                 '-'
             ]
             
-            result = subprocess.run(
+            with self._spawn_ffmpeg(
                 cmd,
-                capture_output=True,
-                text=True,
-                timeout=300
-            )
-            
-            # Parse RMS values from output
-            energy_levels = []
-            for line in result.stderr.split('\n'):
-                if 'RMS level' in line:
-                    try:
-                        # Extract RMS value
-                        value = float(line.split(':')[-1].strip().split()[0])
-                        energy_levels.append(abs(value))
-                    except (ValueError, IndexError):
-                        continue
-            
-            if not energy_levels:
-                # Fallback to uniform distribution
-                return [i * (duration / num_samples) for i in range(num_samples)]
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            ) as process:
+                energy_levels = self._read_energy_levels(process.stdout, duration, num_samples)
             
-            # Find high-energy moments
-            if len(energy_levels) < num_samples:
-                # Interpolate
-                step = len(energy_levels) / num_samples
-                energy_levels = [
-                    energy_levels[int(i * step)]
-                    for i in range(num_samples)
-                ]
-            
-            # Get timestamps of high energy
-            threshold = np.percentile(energy_levels, 70)  # Top 30%
-            high_energy_indices = [
-                i for i, energy in enumerate(energy_levels)
-                if energy >= threshold
-            ]
-            
-            timestamps = [
-                (i / len(energy_levels)) * duration
-                for i in high_energy_indices
-            ]
+            timestamps = self._energy_timestamps(energy_levels, duration, num_samples)
             
             logger.info(f"Detected {len(timestamps)} high-energy moments")
             return timestamps
@@ -154,24 +207,86 @@ class MomentDetector:
             logger.error(f"Error analyzing audio: {e}")
             return []
     
-    def detect_moments(self, video_path, video_duration, target_duration, video_title, scene_times=None):
+    def analyze_video(self, video_path, duration, max_scenes=50, num_samples=100, ffmpeg_threads=None):
+        """
+        Run scene detection and audio energy analysis over a single decode.
+        Returns (scene_times, energy_times).
+        """
+        cmd = [
+            'ffmpeg',
+            '-nostats',
+            *self._thread_args(ffmpeg_threads),
+            '-i', video_path,
+            '-map', '0:v:0',
+            *self._thread_args(ffmpeg_threads),
+            '-vf', f'select=gt(scene\\,{self.scene_threshold}),showinfo',
+            '-f', 'null', '-',
+            '-map', '0:a:0',
+            *self._thread_args(ffmpeg_threads),
+            *self._pcm_output_args(),
+            'pipe:1'
+        ]
+        
+        try:
+            with self._spawn_ffmpeg(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            ) as process, ThreadPoolExecutor(max_workers=1) as executor:
+                # Drain the log on a helper thread while PCM is consumed here
+                log_lines = (line.decode('utf-8', errors='ignore') for line in process.stderr)
+                scene_future = executor.submit(self._parse_scene_times, log_lines, max_scenes)
+                energy_levels = self._read_energy_levels(process.stdout, duration, num_samples)
+                scene_times = scene_future.result()
+        except Exception as e:
+            logger.error(f"Error analyzing video: {e}")
+            return [], []
+        
+        if process.returncode != 0:
+            # Typically a source without audio; analyze each stream separately,
+            # running both ffmpeg processes side by side
+            logger.warning("Combined analysis failed; falling back to separate passes")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                scene_future = executor.submit(
+                    self.detect_scene_changes, video_path, max_scenes, ffmpeg_threads
+                )
+                energy_future = executor.submit(
+                    self.analyze_audio_energy, video_path, duration, num_samples, ffmpeg_threads
+                )
+                return scene_future.result(), energy_future.result()
+        
+        energy_times = self._energy_timestamps(energy_levels, duration, num_samples)
+        
+        logger.info(
+            f"Detected {len(scene_times)} scene changes and {len(energy_times)} high-energy moments"
+        )
+        return scene_times, energy_times
+    
+    def detect_moments(self, video_path, video_duration, target_duration, video_title, scene_times=None,
+                       ffmpeg_threads=None):
         """
         Detect best moments in a video
         Combines scene detection and audio analysis
+        `ffmpeg_threads` caps the threads of each ffmpeg it starts
         """
         try:
             logger.info(f"Detecting moments in {video_title}")
             
-            # Get scene changes
-            scene_times = scene_times if scene_times is not None else self.detect_scene_changes(video_path)
-            
-            # Get high-energy moments
-            energy_times = self.analyze_audio_energy(video_path)
+            if scene_times is None:
+                # Scene changes and high-energy moments from one decode
+                scene_times, energy_times = self.analyze_video(
+                    video_path, video_duration, ffmpeg_threads=ffmpeg_threads
+                )
+            else:
+                # Get high-energy moments
+                energy_times = self.analyze_audio_energy(
+                    video_path, video_duration, ffmpeg_threads=ffmpeg_threads
+                )
             
             # Combine and score moments
-            all_timestamps = sorted(set(scene_times + energy_times))
+            all_timestamps = np.union1d(scene_times, energy_times)
             
-            if not all_timestamps:
+            if not all_timestamps.size:
                 # Fallback to distributed moments
                 return self.distribute_moments(video_duration, target_duration, video_title)
             
@@ -179,33 +294,30 @@ class MomentDetector:
             clip_duration = 7.0  # Average clip duration
             num_clips = max(1, int(target_duration / clip_duration))
             
-            # Score each potential moment
-            scored_moments = []
-            for timestamp in all_timestamps:
-                if timestamp < 5 or timestamp > video_duration - 5:
-                    continue  # Skip beginning and end
-                
-                # Score based on proximity to scene changes and energy peaks
-                scene_score = min([abs(timestamp - t) for t in scene_times + [timestamp]]) if scene_times else 1
-                energy_score = min([abs(timestamp - t) for t in energy_times + [timestamp]]) if energy_times else 1
-                
-                # Closer to both = higher score
-                score = 1.0 / (1 + scene_score + energy_score)
-                
-                # Add randomness for variety
-                score += random.uniform(0, 0.1)
-                
-                scored_moments.append({
-                    'timestamp': timestamp,
-                    'score': score
-                })
+            # Score each potential moment, skipping beginning and end
+            timestamps = all_timestamps.astype(np.float64, copy=False)
+            timestamps = timestamps[(timestamps >= 5) & (timestamps <= video_duration - 5)]
+            
+            # Score based on proximity to scene changes and energy peaks
+            scene_score = self._nearest_distance(timestamps, scene_times)
+            energy_score = self._nearest_distance(timestamps, energy_times)
             
-            # Select top moments
-            scored_moments.sort(key=lambda x: x['score'], reverse=True)
-            selected_moments = scored_moments[:num_clips]
+            # Closer to both = higher score, plus randomness for variety
+            scores = 1.0 / (1 + scene_score + energy_score)
+            scores += np.random.uniform(0, 0.1, size=timestamps.shape)
             
-            # Sort by timestamp for sequential playback
-            selected_moments.sort(key=lambda x: x['timestamp'])
+            # Select top moments (linear-time partition, no full sort)
+            if timestamps.size > num_clips:
+                top_indices = np.argpartition(-scores, num_clips)[:num_clips]
+            else:
+                top_indices = np.arange(timestamps.size)
+            
+            # Sort by timestamp for sequential playback (timestamps are already ascending)
+            top_indices = np.sort(top_indices)
+            selected_moments = [
+                {'timestamp': float(timestamps[i]), 'score': float(scores[i])}
+                for i in top_indices
+            ]
             
             # Create moment objects
             moments = []
@@ -281,6 +393,16 @@ class MomentDetector:
         
         return moments
 
+    def _nearest_distance(self, timestamps, reference_times):
+        """Distance from each timestamp to its closest reference time (1 when there are none)"""
+        if not reference_times:
+            return np.ones_like(timestamps)
+        # Binary search in the sorted references instead of a full distance matrix
+        references = np.sort(np.asarray(reference_times, dtype=np.float64))
+        right = np.searchsorted(references, timestamps).clip(max=references.size - 1)
+        left = (right - 1).clip(min=0)
+        return np.minimum(np.abs(timestamps - references[left]), np.abs(timestamps - references[right]))
+
     def _determine_clip_window(self, timestamp, desired_length, video_duration, scene_times):
         """Expand a clip around a timestamp to capture the full moment"""
         base_start = timestamp - (desired_length / 2)
@@ -0,0 +1,313 @@
+"""
+Session storage for the compiler backend
+Keeps sessions in process memory, or in Redis (REDIS_URL) or SQLite
+(SESSION_DB) so that several server workers share the same sessions
+"""
+
+import os
+import copy
+import json
+import time
+import logging
+import sqlite3
+from contextlib import contextmanager
+from threading import Lock, local
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL_SECONDS = 3600
+
+
+def _dumps(data):
+    return orjson.dumps(data) if orjson is not None else json.dumps(data)
+
+
+def _loads(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+class _SessionLocks:
+    """
+    Update locks of this process. Sessions share a fixed pool of locks picked
+    by hash, so asking for unknown or expired ids never makes it grow.
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self):
+        self._session_locks = [Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def lock(self, session_id):
+        return self._session_locks[hash(session_id) % self.LOCK_STRIPES]
+
+
+class InMemorySessionStore(_SessionLocks):
+    """Dict-backed store, only visible to the current process"""
+
+    # Every change comes from this process
+    shared = False
+
+    def __init__(self):
+        super().__init__()
+        self._sessions = {}
+        self._lock = Lock()
+
+    def get(self, session_id, default=None):
+        return self._sessions.get(session_id, default)
+
+    def get_raw(self, session_id):
+        # Updates replace the stored dict, so it is unchanged while it is the same object
+        return self._sessions.get(session_id)
+
+    def decode(self, raw):
+        return raw
+
+    def get_for_update(self, session_id):
+        # Updates work on a copy that replaces the stored dict in one
+        # assignment, so readers never see a half-updated session
+        session = self._sessions.get(session_id)
+        return copy.deepcopy(session) if session is not None else None
+
+    def __getitem__(self, session_id):
+        return self._sessions[session_id]
+
+    def __setitem__(self, session_id, data):
+        with self._lock:
+            self._sessions[session_id] = data
+
+    def pop(self, session_id, default=None):
+        with self._lock:
+            return self._sessions.pop(session_id, default)
+
+    def items(self):
+        with self._lock:
+            return list(self._sessions.items())
+
+    def purge_expired(self):
+        # Expired by the server's expiry heap
+        pass
+
+
+class RedisSessionStore:
+    """
+    Redis-backed store. Sessions are stored as JSON documents that expire
+    on their own after ttl seconds, so readers get a copy and must write
+    it back after changing it. Update locks live in Redis too, so they
+    hold across every worker process.
+    """
+
+    shared = True
+
+    def __init__(self, client, ttl=SESSION_TTL_SECONDS, prefix='sess:', lock_timeout=30):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+
+    def _key(self, session_id):
+        return f"{self.prefix}{session_id}"
+
+    def get(self, session_id, default=None):
+        raw = self.client.get(self._key(session_id))
+        if raw is None:
+            return default
+        return _loads(raw)
+
+    def get_raw(self, session_id):
+        """Stored JSON document, to compare with an earlier read before decoding it"""
+        return self.client.get(self._key(session_id))
+
+    def decode(self, raw):
+        return _loads(raw)
+
+    def get_for_update(self, session_id):
+        return self.get(session_id)
+
+    def lock(self, session_id):
+        # Expires on its own if the holder dies mid-update
+        return self.client.lock(
+            f"lock:{self._key(session_id)}",
+            timeout=self.lock_timeout,
+            blocking_timeout=self.lock_timeout
+        )
+
+    def __getitem__(self, session_id):
+        data = self.get(session_id)
+        if data is None:
+            raise KeyError(session_id)
+        return data
+
+    def __setitem__(self, session_id, data):
+        self.client.set(self._key(session_id), _dumps(data), ex=self.ttl)
+
+    def pop(self, session_id, default=None):
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        raw, _ = pipe.execute()
+        if raw is None:
+            return default
+        return _loads(raw)
+
+    def items(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}*", count=100))
+        if not keys:
+            return []
+        result = []
+        for key, raw in zip(keys, self.client.mget(keys)):
+            if raw is None:
+                continue
+            if isinstance(key, bytes):
+                key = key.decode()
+            result.append((key[len(self.prefix):], _loads(raw)))
+        return result
+
+    def purge_expired(self):
+        # Keys expire on their own
+        pass
+
+
+class SqliteSessionStore:
+    """
+    SQLite-backed store for several worker processes on one machine,
+    without a Redis server. Sessions are JSON documents that expire after
+    ttl seconds like in Redis. An update holds the database write lock,
+    which excludes updates from every process; readers are never blocked.
+    """
+
+    shared = True
+
+    def __init__(self, path, ttl=SESSION_TTL_SECONDS, lock_timeout=30):
+        self.path = str(path)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        # sqlite3 connections belong to the thread that opened them
+        self._connections = local()
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions '
+            '(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self.purge_expired()
+
+    def _connection(self):
+        conn = getattr(self._connections, 'conn', None)
+        if conn is None:
+            # Autocommit, except inside lock()
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections.conn = conn
+        return conn
+
+    def get(self, session_id, default=None):
+        raw = self.get_raw(session_id)
+        return _loads(raw) if raw is not None else default
+
+    def get_raw(self, session_id):
+        """Stored JSON document, to compare with an earlier read before decoding it"""
+        row = self._connection().execute(
+            'SELECT data FROM sessions WHERE id = ? AND expires_at > ?',
+            (session_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def decode(self, raw):
+        return _loads(raw)
+
+    def get_for_update(self, session_id):
+        return self.get(session_id)
+
+    @contextmanager
+    def lock(self, session_id):
+        # Reads and writes of this thread inside the block share the transaction
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def __getitem__(self, session_id):
+        data = self.get(session_id)
+        if data is None:
+            raise KeyError(session_id)
+        return data
+
+    def __setitem__(self, session_id, data):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+            (session_id, _dumps(data), time.time() + self.ttl)
+        )
+
+    def pop(self, session_id, default=None):
+        # SELECT then DELETE in one write transaction rather than
+        # DELETE ... RETURNING, which needs SQLite 3.35
+        with self.lock(session_id):
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT data, expires_at FROM sessions WHERE id = ?', (session_id,)
+            ).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+        if row is None or row[1] <= time.time():
+            return default
+        return _loads(row[0])
+
+    def purge_expired(self):
+        """Delete expired rows, including those whose worker died before expiring them"""
+        self._connection().execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+
+    def items(self):
+        rows = self._connection().execute(
+            'SELECT id, data FROM sessions WHERE expires_at > ?', (time.time(),)
+        ).fetchall()
+        return [(session_id, _loads(raw)) for session_id, raw in rows]
+
+
+def create_session_store():
+    """
+    Use Redis when REDIS_URL is set and reachable, otherwise SQLite when
+    SESSION_DB is set, otherwise process memory
+    """
+    redis_url = os.environ.get('REDIS_URL')
+    if not redis_url:
+        return _create_sqlite_store()
+
+    try:
+        import redis
+    except ImportError:
+        logger.warning("REDIS_URL is set but redis is not installed")
+        return _create_sqlite_store()
+
+    try:
+        client = redis.Redis.from_url(redis_url)
+        client.ping()
+    except Exception as e:
+        logger.warning(f"Redis unavailable at {redis_url}: {e}")
+        return _create_sqlite_store()
+
+    logger.info(f"Storing sessions in Redis ({redis_url})")
+    return RedisSessionStore(client)
+
+
+def _create_sqlite_store():
+    db_path = os.environ.get('SESSION_DB')
+    if not db_path:
+        logger.info("Keeping sessions in memory (single worker only)")
+        return InMemorySessionStore()
+    try:
+        store = SqliteSessionStore(db_path)
+    except sqlite3.Error as e:
+        logger.warning(f"SQLite session database {db_path} unusable: {e}; keeping sessions in memory")
+        return InMemorySessionStore()
+    logger.info(f"Storing sessions in SQLite ({db_path})")
+    return store
@@ -6,43 +6,89 @@ Handles video compilation and format conversion to TikTok format (9:16)
 import subprocess
 import logging
 import os
+import re
 import json
 import statistics
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 
 import numpy as np
 
+try:
+    # Reads stream dimensions in-process instead of spawning ffprobe
+    import av
+except ImportError:
+    av = None
+
 logger = logging.getLogger(__name__)
 
+# Read size when streaming a compilation to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# x264 speed/size trade-off of the clip encodes, which make up the final
+# downloaded file. veryfast rather than ultrafast: ultrafast turns off CABAC,
+# deblocking and most motion search, which shows under the -b:v cap of each
+# quality. No tuning by default; VC_X264_TUNE=zerolatency drops the lookahead
+# and B-frames, saving memory on small hosts at the cost of quality and size.
+X264_PRESET = os.environ.get('VC_X264_PRESET', 'veryfast')
+X264_TUNE = os.environ.get('VC_X264_TUNE', '')
+X264_SPEED_ARGS = ['-preset', X264_PRESET] + (['-tune', X264_TUNE] if X264_TUNE else [])
+
+# index line, "HH:MM:SS,mmm --> HH:MM:SS,mmm", then text up to the next blank line
+SRT_ENTRY_RE = re.compile(
+    r'^[ \t]*\d+[ \t]*\n'
+    r'[ \t]*(\d+):(\d{2}):(\d{2})[,.](\d{1,3})[ \t]*-->[ \t]*(\d+):(\d{2}):(\d{2})[,.](\d{1,3})[^\n]*\n'
+    r'((?:[ \t]*\S[^\n]*(?:\n|\Z))*)',
+    re.M
+)
+
+
+class CompilationStream:
+    """
+    Byte chunks of a streamed compilation. close() stops ffmpeg and removes
+    the work directory, also when the chunks were never iterated (a
+    generator's finally would not run then); the server calls it when the
+    response is closed.
+    """
+
+    def __init__(self, chunks, work_dir, process=None):
+        self._chunks = chunks
+        self._work_dir = work_dir
+        self._process = process
+        self._closed = False
+
+    def __iter__(self):
+        return self._chunks
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._chunks.close()
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.stdout.close()
+            self._process.wait()
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
 
 class VideoProcessor:
-    def __init__(self, temp_dir):
+    def __init__(self, temp_dir, ffmpeg_slots=None):
         self.temp_dir = Path(temp_dir)
         self.temp_dir.mkdir(parents=True, exist_ok=True)
-
-    def _time_str_to_seconds(self, timestamp: str) -> float:
-        try:
-            hms, millis = timestamp.split(',')
-            hours, minutes, seconds = hms.split(':')
-            return (
-                int(hours) * 3600
-                + int(minutes) * 60
-                + int(seconds)
-                + int(millis) / 1000.0
-            )
-        except Exception:
-            return 0.0
+        # Semaphore shared by everything that starts ffmpeg in this process
+        self.ffmpeg_slots = ffmpeg_slots or nullcontext()
+        # Filters of the installed ffmpeg, listed on first use
+        self._ffmpeg_filters = None
 
     def _seconds_to_time_str(self, seconds: float) -> str:
-        total_ms = max(0, int(round(seconds * 1000)))
-        ms = total_ms % 1000
-        total_seconds = total_ms // 1000
-        s = total_seconds % 60
-        total_minutes = total_seconds // 60
-        m = total_minutes % 60
-        h = total_minutes // 60
+        h, rest = divmod(max(0, int(round(seconds * 1000))), 3600000)
+        m, rest = divmod(rest, 60000)
+        s, ms = divmod(rest, 1000)
         return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
 
     def _slice_subtitles(self, subtitle_path, clip_start, clip_end, work_dir):
@@ -51,90 +97,64 @@ class VideoProcessor:
             return None
 
         try:
-            raw_lines = Path(subtitle_path).read_text(encoding='utf-8', errors='ignore').splitlines()
+            content = Path(subtitle_path).read_text(encoding='utf-8', errors='ignore')
         except Exception:
             return None
 
-        entries = []
-        idx = 0
-        while idx < len(raw_lines):
-            line = raw_lines[idx].strip()
-            if not line:
-                idx += 1
-                continue
-
-            try:
-                int(line)
-            except ValueError:
-                idx += 1
-                continue
-
-            idx += 1
-            if idx >= len(raw_lines):
-                break
-
-            time_line = raw_lines[idx].strip()
-            idx += 1
-            if '-->' not in time_line:
-                continue
-
-            try:
-                start_str, end_str = [segment.strip() for segment in time_line.split('-->')]
-                start_time = self._time_str_to_seconds(start_str)
-                end_time = self._time_str_to_seconds(end_str)
-            except Exception:
-                continue
-
-            text_lines = []
-            while idx < len(raw_lines) and raw_lines[idx].strip():
-                text_lines.append(raw_lines[idx].strip())
-                idx += 1
-
-            # Skip the blank separator
-            while idx < len(raw_lines) and not raw_lines[idx].strip():
-                idx += 1
-
-            if not text_lines:
-                continue
-
-            entries.append((start_time, end_time, '\n'.join(text_lines)))
-
-        if not entries:
-            return None
-
+        # Single pass: clip each entry to the window as it is parsed, so text
+        # is only assembled for the few entries that survive
         clip_duration = clip_end - clip_start
         trimmed_entries = []
-        for start_time, end_time, text in entries:
-            adjusted_start = start_time - clip_start
-            adjusted_end = end_time - clip_start
+        trimmed_append = trimmed_entries.append
+        for sh, sm, ss, sms, eh, em, es, ems, body in SRT_ENTRY_RE.findall(content.replace('\r\n', '\n')):
+            adjusted_start = int(sh) * 3600 + int(sm) * 60 + int(ss) + int(sms.ljust(3, '0')) / 1000.0 - clip_start
+            adjusted_end = int(eh) * 3600 + int(em) * 60 + int(es) + int(ems.ljust(3, '0')) / 1000.0 - clip_start
 
             if adjusted_end <= 0 or adjusted_start >= clip_duration:
                 continue
 
-            adjusted_start = max(0.0, adjusted_start)
-            adjusted_end = min(clip_duration, adjusted_end)
-            trimmed_entries.append((adjusted_start, adjusted_end, text))
+            text = '\n'.join(line.strip() for line in body.split('\n') if line.strip())
+            if not text:
+                continue
+
+            trimmed_append((max(0.0, adjusted_start), min(clip_duration, adjusted_end), text))
 
         if not trimmed_entries:
             return None
 
-        output_path = Path(work_dir) / f"sub_{os.getpid()}_{int(clip_start * 1000)}.srt"
-        with open(output_path, 'w', encoding='utf-8') as handle:
-            for idx, (start_time, end_time, text) in enumerate(trimmed_entries, start=1):
-                handle.write(f"{idx}\n")
-                handle.write(
-                    f"{self._seconds_to_time_str(start_time)} --> {self._seconds_to_time_str(end_time)}\n"
-                )
-                handle.write(f"{text}\n\n")
+        # Unique per call: two clips may share a start time across sources
+        fd, output_name = tempfile.mkstemp(prefix='sub_', suffix='.srt', dir=str(work_dir))
+        os.close(fd)
+        output_path = Path(output_name)
+        to_time_str = self._seconds_to_time_str
+        output_path.write_text(
+            ''.join(
+                f"{idx}\n{to_time_str(start_time)} --> {to_time_str(end_time)}\n{text}\n\n"
+                for idx, (start_time, end_time, text) in enumerate(trimmed_entries, start=1)
+            ),
+            encoding='utf-8'
+        )
 
         return str(output_path)
     
     def _get_video_resolution(self, video_path):
         """Return width and height information for a video"""
+        if av is not None:
+            try:
+                with av.open(str(video_path)) as container:
+                    if container.streams.video:
+                        codec = container.streams.video[0].codec_context
+                        if codec.width and codec.height:
+                            return {'width': codec.width, 'height': codec.height}
+            except Exception as exc:
+                logger.debug(f"PyAV could not read the resolution of {video_path}: {exc}")
         try:
             cmd = [
                 'ffprobe',
                 '-v', 'error',
+                # Width and height are known from the first packets
+                '-analyzeduration', '1000000',
+                '-probesize', '1000000',
                 '-select_streams', 'v:0',
                 '-show_entries', 'stream=width,height',
                 '-of', 'json',
@@ -160,8 +180,17 @@ class VideoProcessor:
             logger.warning(f"Unable to read video resolution: {exc}")
             return {}
 
-    def _estimate_focus_center(self, video_path, sample_frames=12):
-        """Estimate the horizontal focus point to drive smart cropping"""
+    def _get_video_resolutions(self, video_paths):
+        """{path: resolution} for several videos, probed side by side"""
+        video_paths = list(video_paths)
+        if len(video_paths) <= 1:
+            return {path: self._get_video_resolution(path) for path in video_paths}
+        # Probes mostly wait on process start (ffprobe) and disk reads
+        with ThreadPoolExecutor(max_workers=min(8, len(video_paths))) as executor:
+            return dict(zip(video_paths, executor.map(self._get_video_resolution, video_paths)))
+
+    def _estimate_focus_center(self, video_path, sample_frames=12, start_time=0.0, end_time=None):
+        """Estimate the horizontal focus point to drive smart cropping, within an optional time window"""
         try:
             import cv2
         except ImportError:
@@ -176,15 +205,30 @@ class VideoProcessor:
             return 0.5
 
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 0
-        target_samples = sample_frames if frame_count == 0 else min(sample_frames, frame_count)
-        step = max(frame_count // target_samples, 1) if frame_count else 1
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        first_frame, last_frame = 0, frame_count
+        if frame_count and fps:
+            window_first = min(int(start_time * fps), frame_count)
+            window_last = min(int(end_time * fps), frame_count) if end_time else frame_count
+            if window_last > window_first:
+                first_frame, last_frame = window_first, window_last
+        elif start_time:
+            cap.set(cv2.CAP_PROP_POS_MSEC, start_time * 1000)
+
+        window_frames = last_frame - first_frame
+        target_samples = sample_frames if frame_count == 0 else min(sample_frames, window_frames)
+        step = max(window_frames // target_samples, 1) if frame_count else 1
+
+        # Samples under ~2 s apart sit in the same few GOPs: decoding forward
+        # with grab() (no color conversion) beats a seek per sample, which
+        # decodes again from the previous keyframe each time
+        sequential = bool(frame_count and fps and step <= 2 * fps)
 
         focus_points = []
-        current = 0
+        current = first_frame
+        if frame_count:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, current)
         while True:
-            if frame_count:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, current)
-
             ret, frame = cap.read()
             if not ret:
                 break
@@ -216,7 +260,11 @@ class VideoProcessor:
 
             if frame_count:
                 current += step
-                if current >= frame_count:
+                if current >= last_frame:
+                    break
+                if not sequential:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, current)
+                elif not all(cap.grab() for _ in range(step - 1)):
                     break
             else:
                 # Sequential sampling when frame count is unavailable
@@ -230,8 +278,10 @@ class VideoProcessor:
         median_focus = statistics.median(focus_points)
         return float(max(0.1, min(0.9, median_focus)))
     
-    def _create_work_dir(self):
-        path = Path(tempfile.mkdtemp(prefix='session_', dir=str(self.temp_dir)))
+    def _create_work_dir(self, parent=None):
+        parent = Path(parent or self.temp_dir)
+        parent.mkdir(parents=True, exist_ok=True)
+        path = Path(tempfile.mkdtemp(prefix='session_', dir=str(parent)))
         logger.debug(f"Created work directory {path}")
         return path
     
@@ -260,6 +310,31 @@ class VideoProcessor:
         except Exception:
             return False
     
+    def _run_ffmpeg(self, cmd, **kwargs):
+        """subprocess.run for encoding commands, once an ffmpeg slot is free"""
+        with self.ffmpeg_slots:
+            return subprocess.run(cmd, **kwargs)
+    
+    def has_filter(self, name):
+        """Whether the installed ffmpeg provides a filter (listed once per process)"""
+        if self._ffmpeg_filters is None:
+            try:
+                result = subprocess.run(
+                    ['ffmpeg', '-hide_banner', '-filters'],
+                    capture_output=True,
+                    text=True,
+                    timeout=10
+                )
+                # Lines look like " T.C drawtext          V->V       Draw text..."
+                self._ffmpeg_filters = {
+                    parts[1] for parts in (line.split() for line in result.stdout.splitlines())
+                    if len(parts) > 2 and '->' in parts[2]
+                }
+            except Exception as e:
+                logger.warning(f"Could not list ffmpeg filters: {e}")
+                return True
+        return name in self._ffmpeg_filters
+    
     def extract_clip(self, input_path, output_path, start_time, end_time):
         """Extract a clip from a video"""
         try:
@@ -268,14 +343,15 @@ class VideoProcessor:
             cmd = [
                 'ffmpeg',
                 '-y',  # Overwrite output file
-                '-ss', str(start_time),
+                # Input seeking; fixed-point times, as str() may give 1e-05
+                '-ss', f"{start_time:.3f}",
                 '-i', input_path,
-                '-t', str(duration),
+                '-t', f"{max(duration, 0.0):.3f}",
                 '-c', 'copy',  # Copy codec for speed
                 output_path
             ]
             
-            result = subprocess.run(
+            result = self._run_ffmpeg(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -292,12 +368,17 @@ class VideoProcessor:
             logger.error(f"Error extracting clip: {e}")
             raise
     
-    def convert_to_vertical(self, input_path, output_path, quality='720p', subtitle_path=None, layout='crop', header_text=None):
+    def convert_to_vertical(self, input_path, output_path, quality='720p', subtitle_path=None, layout='crop', header_text=None,
+                            metadata=None, start_time=None, end_time=None, threads=0):
         """
         Convert video to vertical TikTok format (9:16)
         Modes:
           - 'crop': Smart focus crop (active pan/scan).
           - 'fit': Fit width, blurred background padding (repost style).
+        `metadata` may carry a pre-probed {width, height} to skip ffprobe.
+        `start_time`/`end_time` cut a window straight from the source using
+        input seeking, so frames outside it are never decoded.
+        `threads` caps ffmpeg's filter and encoder threads (0 = all cores).
         """
         try:
             # Determine output resolution based on quality
@@ -336,7 +417,8 @@ class VideoProcessor:
                     f"x=(w-text_w)/2:y={fontsize}:borderw=4:bordercolor=black"
                 )
 
-            metadata = self._get_video_resolution(input_path)
+            if metadata is None:
+                metadata = self._get_video_resolution(input_path)
             src_width = metadata.get('width')
             src_height = metadata.get('height')
             
@@ -355,15 +437,18 @@ class VideoProcessor:
                 # If video is taller (already vertical), we might crop or fit height, but 'fit' usually implies showing full content.
                 # Simplest 'fit' logic: scale until one dimension matches, usually width.
                 
+                # Decode the source once and fan it out to both branches
+                # instead of pulling [0:v] through the graph twice.
                 bg_chain = (
-                    f"[0:v]scale={width}:{height}:force_original_aspect_ratio=increase,"
+                    f"[0:v]split=2[bgsrc][fgsrc];"
+                    f"[bgsrc]scale={width}:{height}:force_original_aspect_ratio=increase,"
                     f"crop={width}:{height},"
                     f"gblur=sigma=30,eq=brightness=-0.3[bg]"
                 )
                 
                 # Foreground: scale to width, maintain aspect ratio
                 fg_chain = (
-                    f"[0:v]scale={width}:-1[fg]"
+                    f"[fgsrc]scale={width}:-1[fg]"
                 )
                 
                 filter_complex = (
@@ -383,7 +468,11 @@ class VideoProcessor:
                     src_aspect = src_width / src_height if src_height else target_aspect
                     if src_aspect > target_aspect + 0.02:
                         # Wide video - Smart Crop
-                        focus_center = self._estimate_focus_center(input_path)
+                        focus_center = self._estimate_focus_center(
+                            input_path,
+                            start_time=start_time or 0.0,
+                            end_time=end_time
+                        )
 
                         scale_ratio = height / src_height
                         scaled_width = src_width * scale_ratio
@@ -409,21 +498,30 @@ class VideoProcessor:
                 if smart_crop_applied:
                     logger.info(f"Smart focus crop applied at {focus_center:.2f}")
 
+            seek_args = []
+            if start_time is not None:
+                seek_args += ['-ss', f"{start_time:.3f}"]
+                if end_time is not None:
+                    seek_args += ['-t', f"{max(end_time - start_time, 0.0):.3f}"]
+
             cmd = [
                 'ffmpeg',
                 '-y',
+                *seek_args,
                 '-i', input_path,
+                '-filter_threads', str(threads or os.cpu_count() or 1),
                 '-filter_complex', filter_complex,
                 '-map', '[v]',
                 '-map', '0:a?',
                 '-c:v', 'libx264',
-                '-preset', 'medium',
+                *X264_SPEED_ARGS,
                 '-crf', '23',
                 '-b:v', bitrate,
                 '-c:a', 'aac',
                 '-b:a', '128k',
                 '-ar', '44100',
                 '-ac', '2',
+                '-threads', str(threads),
                 output_path
             ]
             
@@ -431,7 +529,7 @@ class VideoProcessor:
             
             # Try first with all filters (including header text)
             try:
-                result = subprocess.run(
+                result = self._run_ffmpeg(
                     cmd,
                     capture_output=True,
                     text=True,
@@ -476,7 +574,7 @@ class VideoProcessor:
                         cmd[cmd.index('-filter_complex') + 1] = filter_complex
                         
                         # Retry
-                        result = subprocess.run(
+                        result = self._run_ffmpeg(
                             cmd,
                             capture_output=True,
                             text=True,
@@ -526,12 +624,12 @@ class VideoProcessor:
                 '-filter_complex', filter_complex,
                 '-map', last_output,
                 '-c:v', 'libx264',
-                '-preset', 'medium',
+                '-preset', 'veryfast',
                 '-crf', '23',
                 output_path
             ])
             
-            result = subprocess.run(
+            result = self._run_ffmpeg(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -547,75 +645,118 @@ class VideoProcessor:
             logger.error(f"Error adding transitions: {e}")
             raise
     
-    def compile_tiktok_video(self, clips_data, output_path, quality='720p', layout='crop', header_text=None):
-        """
-        Main compilation function
-        Takes list of clips with {file_path, start, end, subtitle_path?}
-        Creates a vertical TikTok video with transitions
-        """
-        work_dir = self._create_work_dir()
-        temp_clips = []
-        try:
-            logger.info(f"Compiling {len(clips_data)} clips into TikTok format")
-            
-            # Step 1: Extract and prepare clips
-            for idx, clip_data in enumerate(clips_data):
-                # Extract clip
-                clip_path = work_dir / f"clip_{idx}_{os.getpid()}.mp4"
-                self.extract_clip(
-                    clip_data['file_path'],
-                    str(clip_path),
-                    clip_data['start'],
-                    clip_data['end']
-                )
-                
-                # Convert to vertical format
-                vertical_path = work_dir / f"vertical_{idx}_{os.getpid()}.mp4"
-                sliced_subtitle = None
-                if clip_data.get('subtitle_path'):
-                    sliced_subtitle = self._slice_subtitles(
-                        clip_data['subtitle_path'],
-                        clip_data['start'],
-                        clip_data['end'],
-                        work_dir
-                    )
+    @staticmethod
+    def _clip_key(clip_data):
+        return (
+            clip_data['file_path'],
+            round(float(clip_data['start']), 3),
+            round(float(clip_data['end']), 3),
+            clip_data.get('subtitle_path')
+        )
+
+    def _prepare_vertical_clip(self, idx, clip_data, work_dir, quality, layout, header_text, metadata, threads):
+        """Cut one clip from its source, with its subtitles, as a vertical video in work_dir"""
+        vertical_path = work_dir / f"vertical_{idx}_{os.getpid()}.mp4"
+        sliced_subtitle = None
+        if clip_data.get('subtitle_path'):
+            sliced_subtitle = self._slice_subtitles(
+                clip_data['subtitle_path'],
+                clip_data['start'],
+                clip_data['end'],
+                work_dir
+            )
 
-                self.convert_to_vertical(
-                    str(clip_path),
-                    str(vertical_path),
-                    quality,
-                    subtitle_path=sliced_subtitle,
-                    layout=layout,
-                    header_text=header_text
-                )
-                
-                temp_clips.append(str(vertical_path))
-                
-                if clip_path.exists():
-                    clip_path.unlink()
+        self.convert_to_vertical(
+            clip_data['file_path'],
+            str(vertical_path),
+            quality,
+            subtitle_path=sliced_subtitle,
+            layout=layout,
+            header_text=header_text,
+            metadata=metadata,
+            start_time=clip_data['start'],
+            end_time=clip_data['end'],
+            threads=threads
+        )
+        return str(vertical_path)
+
+    def _render_vertical_clips(self, clips_data, work_dir, quality, layout, header_text, ffmpeg_threads):
+        """Step 1 of a compilation: one vertical video per clip in work_dir, in clip order"""
+        # Probe each source once; every clip is cut straight from it
+        source_metadata = self._get_video_resolutions(
+            dict.fromkeys(clip_data['file_path'] for clip_data in clips_data)
+        )
+        
+        # Identical clips (same source window and subtitles) are rendered once
+        # and listed again in the concat manifest
+        unique_clips = {}
+        for clip_data in clips_data:
+            unique_clips.setdefault(self._clip_key(clip_data), clip_data)
+
+        # Without drawtext every clip would fail once and be encoded again,
+        # so drop the header up front
+        if header_text and not self.has_filter('drawtext'):
+            logger.warning("FFmpeg 'drawtext' filter missing. Compiling without header text.")
+            header_text = None
+
+        # Cut each clip from its source and convert to vertical format,
+        # several clips at once with the thread budget split between them
+        thread_budget = ffmpeg_threads or os.cpu_count() or 4
+        workers = max(1, min(len(unique_clips), thread_budget))
+        threads = max(1, thread_budget // workers)
+
+        def prepare(indexed_clip):
+            idx, clip_data = indexed_clip
+            return self._prepare_vertical_clip(
+                idx, clip_data, work_dir, quality, layout, header_text,
+                source_metadata[clip_data['file_path']], threads
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rendered = dict(zip(unique_clips, executor.map(prepare, enumerate(unique_clips.values()))))
+        return [rendered[self._clip_key(clip_data)] for clip_data in clips_data]
+    
+    def _concat_clips(self, temp_clips, work_dir, output_path):
+        """Step 2 of a compilation: join the rendered clips into output_path"""
+        if len(temp_clips) == 1:
+            os.rename(temp_clips[0], output_path)
+        else:
+            concat_file = work_dir / f"concat_{os.getpid()}.txt"
+            self._write_concat_manifest(temp_clips, concat_file)
             
-            logger.info("All clips extracted and converted to vertical format")
+            cmd = [
+                'ffmpeg',
+                '-y',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', str(concat_file),
+                '-c', 'copy',
+                output_path
+            ]
             
-            # Step 2: Concatenate clips with transitions
-            if len(temp_clips) == 0:
-                raise RuntimeError("Aucun clip à compiler. Vérifie les moments détectés.")
-            if len(temp_clips) == 1:
-                os.rename(temp_clips[0], output_path)
-            else:
-                concat_file = work_dir / f"concat_{os.getpid()}.txt"
-                self._write_concat_manifest(temp_clips, concat_file)
-                
+            result = self._run_ffmpeg(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=600
+            )
+            
+            if result.returncode != 0:
                 cmd = [
                     'ffmpeg',
                     '-y',
                     '-f', 'concat',
                     '-safe', '0',
                     '-i', str(concat_file),
-                    '-c', 'copy',
+                    '-c:v', 'libx264',
+                    # Clips are already encoded at final quality; this is only a rewrap
+                    *X264_SPEED_ARGS,
+                    '-crf', '23',
+                    '-c:a', 'aac',
                     output_path
                 ]
                 
-                result = subprocess.run(
+                result = self._run_ffmpeg(
                     cmd,
                     capture_output=True,
                     text=True,
@@ -623,28 +764,29 @@ class VideoProcessor:
                 )
                 
                 if result.returncode != 0:
-                    cmd = [
-                        'ffmpeg',
-                        '-y',
-                        '-f', 'concat',
-                        '-safe', '0',
-                        '-i', str(concat_file),
-                        '-c:v', 'libx264',
-                        '-preset', 'medium',
-                        '-crf', '23',
-                        '-c:a', 'aac',
-                        output_path
-                    ]
-                    
-                    result = subprocess.run(
-                        cmd,
-                        capture_output=True,
-                        text=True,
-                        timeout=600
-                    )
-                    
-                    if result.returncode != 0:
-                        raise RuntimeError(f"FFmpeg concat error: {result.stderr}")
+                    raise RuntimeError(f"FFmpeg concat error: {result.stderr}")
+    
+    def compile_tiktok_video(self, clips_data, output_path, quality='720p', layout='crop', header_text=None,
+                             ffmpeg_threads=None, work_root=None):
+        """
+        Main compilation function
+        Takes list of clips with {file_path, start, end, subtitle_path?}
+        Creates a vertical TikTok video with transitions
+        `ffmpeg_threads` is the thread budget of this compilation (None = all cores)
+        `work_root` holds the intermediate files (default: the temp directory)
+        """
+        work_dir = self._create_work_dir(work_root)
+        try:
+            logger.info(f"Compiling {len(clips_data)} clips into TikTok format")
+            temp_clips = self._render_vertical_clips(
+                clips_data, work_dir, quality, layout, header_text, ffmpeg_threads
+            )
+            logger.info("All clips extracted and converted to vertical format")
+            
+            # Step 2: Concatenate clips with transitions
+            if len(temp_clips) == 0:
+                raise RuntimeError("Aucun clip à compiler. Vérifie les moments détectés.")
+            self._concat_clips(temp_clips, work_dir, output_path)
             
             logger.info(f"Compilation complete: {output_path}")
             
@@ -664,3 +806,88 @@ class VideoProcessor:
             raise
         finally:
             shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def stream_tiktok_video(self, clips_data, quality='720p', layout='crop', header_text=None,
+                            ffmpeg_threads=None, work_root=None):
+        """
+        Same compilation as compile_tiktok_video, but the clips are joined
+        into a fragmented MP4 on ffmpeg's stdout instead of a file.
+        Returns a CompilationStream; errors before the first byte are
+        raised here, so callers can still answer with an error.
+        """
+        work_dir = self._create_work_dir(work_root)
+        process = None
+        try:
+            logger.info(f"Compiling {len(clips_data)} clips into TikTok format (streamed)")
+            temp_clips = self._render_vertical_clips(
+                clips_data, work_dir, quality, layout, header_text, ffmpeg_threads
+            )
+            if len(temp_clips) == 0:
+                raise RuntimeError("Aucun clip à compiler. Vérifie les moments détectés.")
+            
+            concat_file = work_dir / f"concat_{os.getpid()}.txt"
+            self._write_concat_manifest(temp_clips, concat_file)
+            # Not counted in ffmpeg_slots: a stream copy uses next to no CPU,
+            # and it only exits once the client has read the output, so a
+            # slow download would hold a slot that encodes are waiting for.
+            # A pipe cannot be rewound to write the index at the start,
+            # hence the fragmented layout
+            process = subprocess.Popen(
+                [
+                    'ffmpeg',
+                    '-v', 'error',
+                    '-f', 'concat',
+                    '-safe', '0',
+                    '-i', str(concat_file),
+                    '-c', 'copy',
+                    '-movflags', 'frag_keyframe+empty_moov',
+                    '-f', 'mp4',
+                    'pipe:1'
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            first_chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+            if not first_chunk:
+                # Stream copy refused the clips: join them into a file the
+                # usual way (with its re-encode fallback) and send that
+                process.wait()
+                process.stdout.close()
+                process = None
+                output_path = work_dir / "compilation.mp4"
+                self._concat_clips(temp_clips, work_dir, str(output_path))
+                return CompilationStream(self._iter_file_chunks(output_path), work_dir)
+        except Exception as e:
+            logger.error(f"Error in stream_tiktok_video: {e}")
+            if process is not None:
+                process.kill()
+                process.stdout.close()
+                process.wait()
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        
+        return CompilationStream(self._iter_process_chunks(process, first_chunk), work_dir, process)
+    
+    def _iter_process_chunks(self, process, first_chunk):
+        """
+        Chunks of ffmpeg's output; raises once the output ends if ffmpeg
+        failed, so the server aborts the response instead of ending it
+        normally on a truncated file
+        """
+        try:
+            yield first_chunk
+            # Not pinned for the rest of a possibly slow download
+            del first_chunk
+            yield from iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b'')
+        except BaseException:
+            # Also the client going away mid-download
+            process.kill()
+            raise
+        returncode = process.wait()
+        if returncode != 0:
+            logger.error(f"FFmpeg concat stream exited with code {returncode}")
+            raise RuntimeError(f"La compilation a échoué (ffmpeg code {returncode})")
+    
+    def _iter_file_chunks(self, path):
+        with open(path, 'rb') as handle:
+            yield from iter(lambda: handle.read(STREAM_CHUNK_SIZE), b'')
@@ -11,20 +11,66 @@ from pathlib import Path
 import os
 import re
 import sys
+import json
 import time
+from threading import Lock, local
+from collections import OrderedDict
+from concurrent.futures import Future
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Watch, short link, embed and Shorts URLs, capturing the 11-character ID
+VIDEO_ID_PATTERNS = [
+    re.compile(r'(?:youtube\.com\/watch\?v=|youtu\.be\/|youtube\.com\/embed\/)([a-zA-Z0-9_-]{11})'),
+    re.compile(r'youtube\.com\/shorts\/([a-zA-Z0-9_-]{11})'),
+]
+
+
+def _link(source, target):
+    """Hard-link source to target, keeping target if it already exists"""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+
 
 class YouTubeDownloader:
-    def __init__(self, temp_dir):
+    def __init__(self, temp_dir, shared_cache=None):
         self.temp_dir = Path(temp_dir)
         self.temp_dir.mkdir(exist_ok=True)
         # Optional cookie file for YouTube auth (set env YTDLP_COOKIES=/path/to/cookies.txt)
         default_cookie_path = Path("/tmp/ytdlp_public_cookies.txt")
         self.cookie_file = Path(os.environ.get("YTDLP_COOKIES", default_cookie_path))
         self.cookie_ttl_seconds = 3600  # refresh cookies every hour
+        # Fragmented formats (DASH/HLS) are fetched over several connections,
+        # plain HTTP ones in ranged chunks, as YouTube throttles each connection
+        self.concurrent_fragments = int(os.environ.get("YTDLP_CONCURRENT_FRAGMENTS", 4))
+        self.http_chunk_size = 10 * 1024 * 1024
+        # Downloads kept across sessions and hard-linked into each session
+        # directory, least recently used dropped first (opt-in, 0 disables it)
+        self.video_cache_dir = self.temp_dir / "videos"
+        self.video_cache_max_bytes = int(float(os.environ.get("VC_VIDEO_CACHE_GB", 0)) * 1024 ** 3)
+        self._video_cache_lock = Lock()
         self.generator_script = Path(__file__).parent / "generate_public_cookies.py"
+        # Metadata by video ID, least recently used first: {video_id: (fetched_at, metadata)}
+        self.metadata_ttl_seconds = 3600
+        self.metadata_cache_size = 512
+        self._metadata_cache = OrderedDict()
+        # Without Redis, metadata is also kept on disk so it survives restarts
+        self.metadata_dir = self.temp_dir / "metadata"
+        self.metadata_prune_interval = 600
+        self._metadata_pruned_at = 0.0
+        self._metadata_lock = Lock()
+        # Lookups in flight: {video_id: Future}
+        self._metadata_pending = {}
+        self._metadata_clients = local()
+        # Optional Redis client sharing metadata between server workers
+        self.shared_cache = shared_cache
 
         # Generate cookies upfront if needed (non-auth public session)
         self.ensure_cookies()
@@ -44,53 +90,165 @@ class YouTubeDownloader:
     
     def extract_video_id(self, url):
         """Extract video ID from YouTube URL"""
-        patterns = [
-            r'(?:youtube\.com\/watch\?v=|youtu\.be\/|youtube\.com\/embed\/)([a-zA-Z0-9_-]{11})',
-            r'youtube\.com\/shorts\/([a-zA-Z0-9_-]{11})'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, url)
+        for pattern in VIDEO_ID_PATTERNS:
+            match = pattern.search(url)
             if match:
                 return match.group(1)
         
         raise ValueError(f"Could not extract video ID from URL: {url}")
     
     def get_video_metadata(self, url):
-        """Get video metadata without downloading"""
+        """Get video metadata without downloading (cached per video ID)"""
         try:
             video_id = self.extract_video_id(url)
             
+            with self._metadata_lock:
+                cached = self._metadata_cache.get(video_id)
+                if cached and time.time() - cached[0] < self.metadata_ttl_seconds:
+                    self._metadata_cache.move_to_end(video_id)
+                    return dict(cached[1])
+                # Concurrent lookups of the same video wait for the first one
+                pending = self._metadata_pending.get(video_id)
+                owner = pending is None
+                if owner:
+                    pending = self._metadata_pending[video_id] = Future()
+            
+            if not owner:
+                return dict(pending.result())
+            
+            try:
+                metadata = self._get_shared_metadata(video_id) or self._fetch_metadata(url, video_id)
+                with self._metadata_lock:
+                    self._metadata_cache[video_id] = (time.time(), metadata)
+                    self._metadata_cache.move_to_end(video_id)
+                    while len(self._metadata_cache) > self.metadata_cache_size:
+                        self._metadata_cache.popitem(last=False)
+                pending.set_result(metadata)
+            except Exception as e:
+                pending.set_exception(e)
+                raise
+            finally:
+                with self._metadata_lock:
+                    self._metadata_pending.pop(video_id, None)
+            return dict(metadata)
+        
+        except Exception as e:
+            logger.error(f"Error getting metadata for {url}: {e}")
+            raise
+    
+    def _metadata_client(self):
+        """
+        yt-dlp instance for metadata lookups, one per thread (YoutubeDL is
+        not thread-safe) and kept between calls so its HTTP connections
+        stay open. Rebuilt when the cookie file changes.
+        """
+        cookie_file = None
+        if self.cookie_file and Path(self.cookie_file).exists():
+            cookie_file = (str(self.cookie_file), Path(self.cookie_file).stat().st_mtime)
+        
+        client = getattr(self._metadata_clients, 'current', None)
+        if client is None or client[0] != cookie_file:
+            if client is not None:
+                client[1].close()
             ydl_opts = {
                 'quiet': True,
                 'no_warnings': True,
                 'extract_flat': False,
             }
-            
-            if self.cookie_file and Path(self.cookie_file).exists():
-                ydl_opts['cookiefile'] = str(self.cookie_file)
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                duration = info.get('duration', 0)
-                duration_formatted = f"{duration // 60}:{duration % 60:02d}"
-                
-                return {
-                    'id': video_id,
-                    'title': info.get('title', 'Unknown Title'),
-                    'channel': info.get('uploader', 'Unknown Channel'),
-                    'duration': duration,
-                    'duration_formatted': duration_formatted,
-                    'thumbnail': info.get('thumbnail', ''),
-                    'description': info.get('description', ''),
-                    'view_count': info.get('view_count', 0),
-                    'like_count': info.get('like_count', 0)
-                }
+            if cookie_file:
+                ydl_opts['cookiefile'] = cookie_file[0]
+            client = self._metadata_clients.current = (cookie_file, yt_dlp.YoutubeDL(ydl_opts))
+        return client[1]
+    
+    def _fetch_metadata(self, url, video_id):
+        """Ask yt-dlp for the metadata and share it with the other workers"""
+        info = self._metadata_client().extract_info(url, download=False)
+        
+        duration = info.get('duration', 0)
+        duration_formatted = f"{duration // 60}:{duration % 60:02d}"
+        
+        metadata = {
+            'id': video_id,
+            'title': info.get('title', 'Unknown Title'),
+            'channel': info.get('uploader', 'Unknown Channel'),
+            'duration': duration,
+            'duration_formatted': duration_formatted,
+            'thumbnail': info.get('thumbnail', ''),
+            'description': info.get('description', ''),
+            'view_count': info.get('view_count', 0),
+            'like_count': info.get('like_count', 0)
+        }
         
+        self._set_shared_metadata(video_id, metadata)
+        return metadata
+    
+    def _get_shared_metadata(self, video_id):
+        """Metadata another worker (or an earlier run) already fetched, or None"""
+        if self.shared_cache is None:
+            return self._read_metadata_file(video_id)
+        try:
+            raw = self.shared_cache.get(f"meta:{video_id}")
+            if not raw:
+                return None
+            return orjson.loads(raw) if orjson is not None else json.loads(raw)
         except Exception as e:
-            logger.error(f"Error getting metadata for {url}: {e}")
-            raise
+            logger.warning(f"Shared metadata cache unavailable: {e}")
+            return None
+    
+    def _set_shared_metadata(self, video_id, metadata):
+        if self.shared_cache is None:
+            self._write_metadata_file(video_id, metadata)
+            return
+        try:
+            raw = orjson.dumps(metadata) if orjson is not None else json.dumps(metadata)
+            self.shared_cache.set(f"meta:{video_id}", raw, ex=self.metadata_ttl_seconds)
+        except Exception as e:
+            logger.warning(f"Could not store metadata in shared cache: {e}")
+    
+    def _read_metadata_file(self, video_id):
+        path = self.metadata_dir / f"{video_id}.json"
+        try:
+            if time.time() - path.stat().st_mtime >= self.metadata_ttl_seconds:
+                return None
+            raw = path.read_bytes()
+            return orjson.loads(raw) if orjson is not None else json.loads(raw)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unreadable metadata cache file {path}: {e}")
+            return None
+    
+    def _write_metadata_file(self, video_id, metadata):
+        try:
+            self.metadata_dir.mkdir(exist_ok=True)
+            raw = orjson.dumps(metadata) if orjson is not None else json.dumps(metadata).encode()
+            # Written aside then renamed, so other workers never read a partial file
+            tmp_path = self.metadata_dir / f"{video_id}.{os.getpid()}.tmp"
+            tmp_path.write_bytes(raw)
+            os.replace(tmp_path, self.metadata_dir / f"{video_id}.json")
+        except OSError as e:
+            logger.warning(f"Could not store metadata on disk: {e}")
+    
+    def prune_metadata_files(self):
+        """Remove expired metadata files; called periodically, does the scan at most every metadata_prune_interval"""
+        now = time.time()
+        if now - self._metadata_pruned_at < self.metadata_prune_interval:
+            return
+        self._metadata_pruned_at = now
+        expired_before = now - self.metadata_ttl_seconds
+        try:
+            with os.scandir(self.metadata_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.stat().st_mtime < expired_before:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        # Already removed by another worker
+                        pass
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not prune metadata cache files: {e}")
     
     def _find_subtitle_file(self, base_output: Path):
         """Locate a downloaded subtitle file near the video output"""
@@ -131,12 +289,23 @@ class YouTubeDownloader:
     def download_video(self, url, session_id, video_id, download_subtitles=True, progress_callback=None):
         """Download video and optional subtitles. Returns (video_path, subtitle_path)."""
         try:
-            output_path = self.temp_dir / f"{session_id}_{video_id}.mp4"
+            # One directory per session so cleanup is a single rmtree
+            session_dir = self.temp_dir / "sessions" / session_id
+            session_dir.mkdir(parents=True, exist_ok=True)
+            output_path = session_dir / f"{video_id}.mp4"
+
+            cached = self._link_cached_video(video_id, output_path, bool(download_subtitles))
+            if cached:
+                video_path, subtitle_path = cached
+                logger.info(f"Reusing cached download of {video_id}")
+                return str(video_path), str(subtitle_path) if subtitle_path else None
 
             def build_opts(enable_subs: bool):
                 opts = {
                     'format': 'best[ext=mp4][height<=1080]/best[ext=mp4]/best',
                     'outtmpl': str(output_path),
+                    'concurrent_fragment_downloads': self.concurrent_fragments,
+                    'http_chunk_size': self.http_chunk_size,
                     'quiet': False,
                     'no_warnings': False,
                     'extract_audio': False,
@@ -144,8 +313,10 @@ class YouTubeDownloader:
                     'writeautomaticsub': enable_subs,
                     'subtitlesformat': 'srt',
                     'subtitleslangs': ['fr', 'en', 'fr.*', 'en.*'],
+                    # Non-MP4 downloads are rewrapped (stream copy), not
+                    # re-encoded: clips are encoded once at compile time
                     'postprocessors': [{
-                        'key': 'FFmpegVideoConvertor',
+                        'key': 'FFmpegVideoRemuxer',
                         'preferedformat': 'mp4',
                     }],
                 }
@@ -222,6 +393,7 @@ class YouTubeDownloader:
                 logger.info("Subtitle download skipped or disabled for this video.")
 
             logger.info(f"Successfully downloaded to {output_path}")
+            self._store_cached_video(video_id, output_path, subtitle_path, attempt_subtitles)
             return str(output_path), str(subtitle_path) if subtitle_path else None
 
         except Exception as e:
@@ -229,14 +401,84 @@ class YouTubeDownloader:
             raise
 
     # Internal helpers
+    def _link_cached_video(self, video_id, output_path, with_subtitles):
+        """Hard-link a cached download into the session directory: (video_path, subtitle_path), or None on a miss"""
+        if self.video_cache_max_bytes <= 0:
+            return None
+        cached = self.video_cache_dir / f"{video_id}.mp4"
+        cached_subtitles = cached.with_suffix('.srt')
+        if with_subtitles and not (cached_subtitles.exists() or cached.with_suffix('.nosubs').exists()):
+            # Cached by a session that skipped subtitles
+            return None
+        try:
+            _link(cached, output_path)
+        except OSError:
+            return None
+        subtitle_path = None
+        if with_subtitles:
+            subtitle_path = output_path.with_suffix('.srt')
+            try:
+                _link(cached_subtitles, subtitle_path)
+            except OSError:
+                # Missing when the video has no subtitles (.nosubs)
+                subtitle_path = None
+        try:
+            # Recency for eviction
+            os.utime(cached)
+        except OSError:
+            pass
+        return output_path, subtitle_path
+
+    def _store_cached_video(self, video_id, video_path, subtitle_path, with_subtitles):
+        """Keep a finished download for later sessions, then trim the cache"""
+        if self.video_cache_max_bytes <= 0 or video_path.suffix != '.mp4':
+            return
+        cached = self.video_cache_dir / f"{video_id}.mp4"
+        try:
+            self.video_cache_dir.mkdir(exist_ok=True)
+            # Subtitles first, so a cached video always has its subtitle state
+            if subtitle_path:
+                _link(subtitle_path, cached.with_suffix('.srt'))
+            elif with_subtitles:
+                cached.with_suffix('.nosubs').touch()
+            _link(video_path, cached)
+        except OSError as exc:
+            logger.warning(f"Could not cache download of {video_id}: {exc}")
+            return
+        self._evict_cached_videos()
+
+    def _evict_cached_videos(self):
+        """Drop the least recently used cached videos until the cache fits its size cap"""
+        with self._video_cache_lock:
+            try:
+                with os.scandir(self.video_cache_dir) as entries:
+                    videos = [
+                        (entry.stat().st_mtime, entry.stat().st_size, Path(entry.path))
+                        for entry in entries if entry.name.endswith('.mp4')
+                    ]
+            except OSError as exc:
+                logger.warning(f"Could not scan video cache: {exc}")
+                return
+            total = sum(size for _, size, _ in videos)
+            for _, size, path in sorted(videos):
+                if total <= self.video_cache_max_bytes:
+                    break
+                # Sessions using the video keep their own hard link to it
+                for cache_file in (path, path.with_suffix('.srt'), path.with_suffix('.nosubs')):
+                    cache_file.unlink(missing_ok=True)
+                total -= size
+                logger.info(f"Evicted {path.name} from the video cache")
+
     def ensure_cookies(self):
         """Generate a fresh public cookie jar if missing or stale."""
         try:
             path = Path(self.cookie_file)
-            if path.exists():
+            try:
                 age = time.time() - path.stat().st_mtime
-                if age < self.cookie_ttl_seconds:
-                    return
+            except FileNotFoundError:
+                age = None
+            if age is not None and age < self.cookie_ttl_seconds:
+                return
 
             if not self.generator_script.exists():
                 logger.warning("Cookie generator script not found; continuing without cookies.")